@@ -7,6 +7,7 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint as checkpoint
 
 from typing import Optional, Tuple, Type
 
@@ -41,6 +42,7 @@ class ImageEncoderViT(nn.Module):
         rel_pos_zero_init: bool = True,
         window_size: int = 0,
         global_attn_indexes: Tuple[int, ...] = (),
+        use_checkpoint: bool = False,
     ) -> None:
         """
         Args:
@@ -59,9 +61,11 @@ class ImageEncoderViT(nn.Module):
             rel_pos_zero_init (bool): If True, zero initialize relative positional parameters.
             window_size (int): Window size for window attention blocks.
             global_attn_indexes (list): Indexes for blocks using global attention.
+            use_checkpoint (bool): If True, recompute block activations in the backward pass to save memory.
         """
         super().__init__()
         self.img_size = img_size
+        self.use_checkpoint = use_checkpoint
         self.embed_dim = embed_dim
         self.depth = depth
 
@@ -143,7 +147,10 @@ class ImageEncoderViT(nn.Module):
         outs = []
         for i, blk in enumerate(self.blocks):
             x = prompt[i].reshape(B, H, W, -1) + x
-            x = blk(x)
+            if self.use_checkpoint and self.training:
+                x = checkpoint.checkpoint(blk, x, use_reentrant=False)
+            else:
+                x = blk(x)
             if i in self.out_indices:
                 outs.append(x)
 
@@ -92,7 +92,7 @@ class PositionEmbeddingRandom(nn.Module):
 
 @register('sam')
 class SAM(nn.Module):
-    def __init__(self, inp_size=None, encoder_mode=None, loss=None):
+    def __init__(self, inp_size=None, encoder_mode=None, loss=None, use_checkpoint=False):
         super().__init__()
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         self.embed_dim = encoder_mode['embed_dim']
@@ -112,6 +112,7 @@ class SAM(nn.Module):
             rel_pos_zero_init=True,
             window_size=encoder_mode['window_size'],
             global_attn_indexes=encoder_mode['global_attn_indexes'],
+            use_checkpoint=use_checkpoint,
         )
         self.prompt_embed_dim = encoder_mode['prompt_embed_dim']
         self.mask_decoder = MaskDecoder(
@@ -149,6 +150,12 @@ class SAM(nn.Module):
         self.inp_size = inp_size
         self.image_embedding_size = inp_size // encoder_mode['patch_size']
         self.no_mask_embed = nn.Embedding(1, encoder_mode['prompt_embed_dim'])
+        # Mixed precision is off by default; the scaler is only enabled for fp16 autocast
+        self.use_amp = False
+        self.amp_dtype = torch.float16
+        self.scaler = torch.cuda.amp.GradScaler(enabled=False)
+        # Number of forward_backward() calls whose gradients are summed per step()
+        self.accum_steps = 1
 
     def set_input(self, input, gt_mask):
         self.input = input.to(self.device)
@@ -247,17 +254,26 @@ class SAM(nn.Module):
 
     def backward_G(self):
         """Calculate GAN and L1 loss for the generator"""
-        self.loss_G = self.criterionBCE(self.pred_mask, self.gt_mask)
-        if self.loss_mode == 'iou':
-            self.loss_G += _iou_loss(self.pred_mask, self.gt_mask)
+        with torch.cuda.amp.autocast(enabled=self.use_amp, dtype=self.amp_dtype):
+            self.loss_G = self.criterionBCE(self.pred_mask, self.gt_mask)
+            if self.loss_mode == 'iou':
+                self.loss_G += _iou_loss(self.pred_mask, self.gt_mask)
 
-        self.loss_G.backward()
+        self.scaler.scale(self.loss_G / self.accum_steps).backward()
 
-    def optimize_parameters(self):
-        self.forward()
-        self.optimizer.zero_grad()  # set G's gradients to zero
+    def forward_backward(self):
+        with torch.cuda.amp.autocast(enabled=self.use_amp, dtype=self.amp_dtype):
+            self.forward()
         self.backward_G()  # calculate graidents for G
-        self.optimizer.step()  # udpate G's weights
+
+    def step(self):
+        self.scaler.step(self.optimizer)  # udpate G's weights
+        self.scaler.update()
+        self.optimizer.zero_grad(set_to_none=True)  # set G's gradients to zero
+
+    def optimize_parameters(self):
+        self.forward_backward()
+        self.step()
 
     def set_requires_grad(self, nets, requires_grad=False):
         """Set requies_grad=Fasle for all the networks to avoid unnecessary computations
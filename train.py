@@ -67,7 +67,7 @@ def eval_psnr(loader, model, eval_type=None):
     gt_list = []
     for batch in loader:
         for k, v in batch.items():
-            batch[k] = v.cuda()
+            batch[k] = v.cuda(non_blocking=True)
 
         inp = batch['inp']
 
@@ -122,7 +122,7 @@ def train(train_loader, model):
     loss_list = []
     for batch in train_loader:
         for k, v in batch.items():
-            batch[k] = v.to(device)
+            batch[k] = v.to(device, non_blocking=True)
         inp = batch['inp']
         gt = batch['gt']
         model.set_input(inp, gt)
@@ -1,13 +1,14 @@
 import argparse
 import os
+import inspect
 import yaml
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 from torch.utils.data import DataLoader
 from torch.optim.lr_scheduler import CosineAnnealingLR
 import datasets
 import models
 import utils
-from statistics import mean
 import torch
 
 def make_data_loader(spec, tag=''):
@@ -17,11 +18,18 @@ def make_data_loader(spec, tag=''):
     dataset = datasets.make(spec['dataset'])
     dataset = datasets.make(spec['wrapper'], args={'dataset': dataset})
     print('{} dataset: size={}'.format(tag, len(dataset)))
-    for k, v in dataset[0].items():
-        print('  {}: shape={}'.format(k, tuple(v.shape)))
-
+    # 读取第0个样本会完整解码一张图片，只在需要时打印形状
+    if spec.get('probe_shapes', False):
+        for k, v in dataset[0].items():
+            print('  {}: shape={}'.format(k, tuple(v.shape)))
+
+    num_workers = spec.get('num_workers', 8)
+    loader_kwargs = {}
+    if num_workers > 0:
+        loader_kwargs['persistent_workers'] = True
+        loader_kwargs['prefetch_factor'] = spec.get('prefetch_factor', 4)
     loader = DataLoader(dataset, batch_size=spec['batch_size'],
-        shuffle=True, num_workers=4, pin_memory=True)
+        shuffle=True, num_workers=num_workers, pin_memory=True, **loader_kwargs)
     return loader
 
 def make_data_loaders():
@@ -29,97 +37,223 @@ def make_data_loaders():
     val_loader = make_data_loader(config.get('val_dataset'), tag='val')
     return train_loader, val_loader
 
+def _update_metric(metric, pred, gt, done):
+    # 等待该批的 D2H 拷贝完成后再在CPU上读取
+    done.synchronize()
+    metric.update(pred.float().sigmoid_(), gt.float())
+
 def eval_psnr(loader, model, eval_type=None):
     model.eval()
 
     if eval_type == 'f1':
-        metric_fn = utils.calc_f1
+        metric = utils.F1Metric()
         metric1, metric2, metric3, metric4 = 'f1', 'auc', 'none', 'none'
     elif eval_type == 'fmeasure':
-        metric_fn = utils.calc_fmeasure
+        metric = utils.FmeasureMetric()
         metric1, metric2, metric3, metric4 = 'f_mea', 'mae', 'none', 'none'
     elif eval_type == 'ber':
-        metric_fn = utils.calc_ber
+        metric = utils.BERMetric()
         metric1, metric2, metric3, metric4 = 'shadow', 'non_shadow', 'ber', 'none'
     elif eval_type == 'cod':
-        metric_fn = utils.calc_cod
+        metric = utils.CODMetric()
         metric1, metric2, metric3, metric4 = 'sm', 'em', 'wfm', 'mae'
 
     pbar = tqdm(total=len(loader), leave=False, desc='val')
 
-    pred_list = []
-    gt_list = []
-    for batch in loader:
-        for k, v in batch.items():
-            batch[k] = v.cuda()
-
-        inp = batch['inp']
-        pred = torch.sigmoid(model.infer(inp))
-        pred_list.append(pred)
-        gt_list.append(batch['gt'])
-        pbar.update(1)
-
-    pbar.close()
-
-    pred_list = torch.cat(pred_list, 0)
-    gt_list = torch.cat(gt_list, 0)
-    result1, result2, result3, result4 = metric_fn(pred_list, gt_list)
+    with torch.inference_mode():
+        prefetcher = utils.DataPrefetcher(loader)
+        pending = None
+        batch = prefetcher.next()
+        while batch is not None:
+            inp = batch['inp'].contiguous(memory_format=torch.channels_last)
+            with torch.cuda.amp.autocast(enabled=model.use_amp, dtype=model.amp_dtype):
+                pred = model.infer(inp)
+            # 逐批异步转存到CPU(fp16)，避免验证集整体占用显存
+            done = torch.cuda.Event()
+            current = (pred.to('cpu', dtype=torch.float16, non_blocking=True),
+                       batch['gt'].to('cpu', dtype=torch.float16, non_blocking=True), done)
+            done.record()
+            # 当前批的前向已在GPU上排队，此时在CPU上累积上一批的指标
+            if pending is not None:
+                _update_metric(metric, *pending)
+            pending = current
+            pbar.update(1)
+            batch = prefetcher.next()
+
+        if pending is not None:
+            _update_metric(metric, *pending)
+        pbar.close()
+    result1, result2, result3, result4 = metric.compute()
 
     return result1, result2, result3, result4, metric1, metric2, metric3, metric4
 
-def prepare_training():
+def load_checkpoint(path):
+    """直接映射到GPU加载，torch 版本支持时使用 mmap 避免在CPU内存中暂存一份"""
+    load_kwargs = {'map_location': 'cuda', 'weights_only': True}
+    if 'mmap' in inspect.signature(torch.load).parameters:
+        load_kwargs['mmap'] = True
+    return torch.load(path, **load_kwargs)
+
+def set_trainable(model):
+    """默认训练全部参数；freeze_backbone 时只训练名字包含 trainable_keys 的参数"""
+    if not config.get('freeze_backbone', False):
+        for name, para in model.named_parameters():
+            para.requires_grad_(True)
+        return
+    trainable_keys = config.get('trainable_keys', ['prompt_generator', 'mask_decoder', 'no_mask_embed'])
+    for name, para in model.named_parameters():
+        para.requires_grad_(any(k in name for k in trainable_keys))
+
+def prepare_training(save_path):
+    model_args = {'use_checkpoint': config.get('grad_checkpoint', True)}
+    ckpt = None
     if config.get('resume') is not None:
-        model = models.make(config['model']).cuda()
+        resume_path = config.get('resume_path', os.path.join(save_path, 'model_last.pth'))
+        print('Resuming from:', resume_path)
+        ckpt = load_checkpoint(resume_path)
+        model = models.make(config['model'], args=model_args).cuda()
+        model.load_state_dict(ckpt['model_spec']['sd'])
+        set_trainable(model)
         optimizer = utils.make_optimizer(
-            model.parameters(), config['optimizer'])
+            filter(lambda p: p.requires_grad, model.parameters()), config['optimizer'])
+        saved_sizes = [len(g['params']) for g in ckpt['optimizer_spec']['sd']['param_groups']]
+        current_sizes = [len(g['params']) for g in optimizer.param_groups]
+        if saved_sizes != current_sizes:
+            raise ValueError(
+                'cannot resume optimizer from {}: it holds {} parameter tensors per group, '
+                'but the current trainable set has {}; freeze_backbone/trainable_keys must match '
+                'the run that wrote the checkpoint'.format(resume_path, saved_sizes, current_sizes))
+        optimizer.load_state_dict(ckpt['optimizer_spec']['sd'])
+        # 旧的 checkpoint 没有记录 epoch，只能沿用配置中的 resume
+        if ckpt.get('epoch') is not None and ckpt['epoch'] != config.get('resume'):
+            raise ValueError(
+                'cannot resume from {}: it was written after epoch {}, but resume is set to {}; '
+                'the model, optimizer and LR schedule would not match the epoch counter'.format(
+                    resume_path, ckpt['epoch'], config.get('resume')))
         epoch_start = config.get('resume') + 1
     else:
-        model = models.make(config['model']).cuda()
+        model = models.make(config['model'], args=model_args).cuda()
+        set_trainable(model)
         optimizer = utils.make_optimizer(
-            model.parameters(), config['optimizer'])
+            filter(lambda p: p.requires_grad, model.parameters()), config['optimizer'])
         epoch_start = 1
+    model = model.to(memory_format=torch.channels_last)
+    if config.get('compile', True) and hasattr(torch, 'compile'):
+        # 只编译前向方法，模块本身不被包装，state_dict 的键保持不变
+        model.forward = torch.compile(model.forward, mode='max-autotune', fullgraph=False)
+        model.infer = torch.compile(model.infer, mode='max-autotune', fullgraph=False)
+    model.use_amp = config.get('amp', True)
+    # bf16 与 fp32 的数值范围相同，不需要 loss scaling；只在 Ampere 及以上使用，
+    # 新版 torch 的 is_bf16_supported() 在 V100/T4 上也会因模拟而返回 True，那里 bf16 没有 tensor core 加速，退回 fp16 + GradScaler
+    model.amp_dtype = torch.bfloat16 if torch.cuda.get_device_capability()[0] >= 8 else torch.float16
+    model.scaler = torch.cuda.amp.GradScaler(enabled=model.use_amp and model.amp_dtype == torch.float16)
+    model.accum_steps = config.get('accum_steps', 1)
     max_epoch = config.get('epoch_max')
     lr_scheduler = CosineAnnealingLR(optimizer, max_epoch, eta_min=config.get('lr_min'))
+    if ckpt is not None:
+        # 恢复学习率调度和 GradScaler 的状态，旧的 checkpoint 中可能没有
+        if ckpt.get('scheduler_sd') is not None:
+            lr_scheduler.load_state_dict(ckpt['scheduler_sd'])
+        if ckpt.get('scaler_sd'):
+            model.scaler.load_state_dict(ckpt['scaler_sd'])
     print('model: #params={}'.format(utils.compute_num_params(model, text=True)))
     return model, optimizer, epoch_start, lr_scheduler
 
-def train(train_loader, model):
+def train(train_loader, model, tail_hook=None, tail_steps=0):
+    """tail_hook 在剩余 tail_steps 个 batch 时调用一次，用于提前启动验证数据的预取"""
     model.train()
+    hook_at = max(len(train_loader) - tail_steps, 0)
     pbar = tqdm(total=len(train_loader), leave=False, desc='train')
-    loss_list = []
+    # 损失在GPU上累加，避免每步 .item() 引起的同步
+    loss_sum = torch.zeros((), device='cuda')
+    n = 0
     
-    for batch in train_loader:
-        for k, v in batch.items():
-            batch[k] = v.cuda()
-        inp = batch['inp']
+    prefetcher = utils.DataPrefetcher(train_loader)
+    batch = prefetcher.next()
+    while batch is not None:
+        if tail_hook is not None and n >= hook_at:
+            tail_hook()
+            tail_hook = None
+        inp = batch['inp'].contiguous(memory_format=torch.channels_last)
         gt = batch['gt']
         model.set_input(inp, gt)
-        model.optimize_parameters()
-        loss_list.append(model.loss_G.item())
+        model.forward_backward()
+        loss_sum += model.loss_G.detach().float()
+        n += 1
+        if n % model.accum_steps == 0:
+            model.step()
         pbar.update(1)
+        batch = prefetcher.next()
 
+    if tail_hook is not None:
+        tail_hook()
+    # 处理 epoch 末尾不足 accum_steps 的剩余梯度
+    if n % model.accum_steps != 0:
+        model.step()
     pbar.close()
-    return mean(loss_list)
-
-def save_model(config, model, save_path, name):
-    """保存模型和优化器状态"""
-    model_spec = config['model']
-    model_spec['sd'] = model.state_dict()
-    optimizer_spec = config['optimizer']
-    optimizer_spec['sd'] = model.optimizer.state_dict()
-    
+    return (loss_sum / n).item()
+
+# 单线程的后台保存，磁盘写入不阻塞训练
+_save_pool = ThreadPoolExecutor(max_workers=1)
+_save_futures = []
+
+def _to_cpu(obj):
+    # 使用阻塞拷贝到普通内存，避免每次快照都占用数GB锁页内存
+    if torch.is_tensor(obj):
+        return obj.detach().cpu()
+    if isinstance(obj, dict):
+        return {k: _to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return obj
+
+def _check_saves(wait=False):
+    # 取出已完成的保存任务，写盘失败时在主线程抛出异常
+    for future in list(_save_futures):
+        if wait or future.done():
+            _save_futures.remove(future)
+            future.result()
+
+def save_model(config, model, save_path, name, epoch, force=False, state=None):
+    """保存模型和优化器状态，force 时等待之前的写盘完成，保证本次一定保存
+
+    state 为本 epoch 已拷贝到CPU的快照时直接复用；返回本次写盘的快照，跳过时返回 None
+    """
+    _check_saves(wait=force)
+    if name == 'last' and _save_futures:
+        log('skip saving last: previous checkpoint is still being written, '
+            'model_last.pth is from an earlier epoch')
+        return None
+    if state is None:
+        # 先拷贝到CPU，后台线程写盘时不会受后续训练修改参数的影响
+        model_spec = dict(config['model'], sd=_to_cpu(model.state_dict()))
+        optimizer_spec = dict(config['optimizer'], sd=_to_cpu(model.optimizer.state_dict()))
+        state = {
+            'epoch': epoch,
+            'model_spec': model_spec,
+            'optimizer_spec': optimizer_spec,
+            'scheduler_sd': model.lr_scheduler.state_dict(),
+            'scaler_sd': model.scaler.state_dict(),
+        }
+
     save_file = os.path.join(save_path, f'model_{name}.pth')
-    torch.save({
-        'model_spec': model_spec,
-        'optimizer_spec': optimizer_spec,
-    }, save_file)
+    _save_futures.append(_save_pool.submit(torch.save, state, save_file))
+    return state
+
+def wait_for_save():
+    _check_saves(wait=True)
 
 def main(config_, save_path):
     global config, log, writer, log_info
     config = config_
+    if config.get('cudnn_benchmark', True):
+        # 输入尺寸固定，让 cuDNN 自动选择最快的卷积算法，并启用 TF32
+        torch.backends.cudnn.benchmark = True
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
     log, writer = utils.set_save_path(save_path, remove=False)
     with open(os.path.join(save_path, 'config.yaml'), 'w') as f:
-        yaml.dump(config, f, sort_keys=False)
+        yaml.dump(config, f, sort_keys=False, Dumper=getattr(yaml, 'CSafeDumper', yaml.SafeDumper))
 
     train_loader, val_loader = make_data_loaders()
     if config.get('data_norm') is None:
@@ -128,25 +262,23 @@ def main(config_, save_path):
             'gt': {'sub': [0], 'div': [1]}
         }
 
-    model, optimizer, epoch_start, lr_scheduler = prepare_training()
+    model, optimizer, epoch_start, lr_scheduler = prepare_training(save_path)
     model.optimizer = optimizer
-    lr_scheduler = CosineAnnealingLR(model.optimizer, config['epoch_max'], eta_min=config.get('lr_min'))
+    model.lr_scheduler = lr_scheduler
 
     model = model.cuda()
     
-    # 如果配置中有预训练模型路径，则加载它
-    if 'sam_checkpoint' in config:
+    # 如果配置中有预训练模型路径，则加载它（断点续训时权重已从 checkpoint 恢复）
+    if config.get('resume') is not None:
+        print('Pretrained model skipped, weights restored from resume checkpoint')
+    elif 'sam_checkpoint' in config:
         print('Loading pretrained model from:', config['sam_checkpoint'])
-        sam_checkpoint = torch.load(config['sam_checkpoint'], weights_only=True)
+        sam_checkpoint = load_checkpoint(config['sam_checkpoint'])
         model.load_state_dict(sam_checkpoint, strict=False)
         print('Pretrained model loaded successfully')
     else:
         print('Training from scratch without pretrained model')
     
-    # 设置所有参数可训练
-    for name, para in model.named_parameters():
-        para.requires_grad_(True)
-    
     model_total_params = sum(p.numel() for p in model.parameters())
     model_grad_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
     print('model_grad_params:' + str(model_grad_params), '\nmodel_total_params:' + str(model_total_params))
@@ -158,7 +290,17 @@ def main(config_, save_path):
     
     for epoch in range(epoch_start, epoch_max + 1):
         t_epoch_start = timer.t()
-        train_loss_G = train(train_loader, model)
+        do_val = (epoch_val is not None) and (epoch % epoch_val == 0)
+        val_batches = None
+
+        def start_val_prefetch():
+            # 在训练的最后 val_prefetch_steps 步开始后台预取验证数据，
+            # 过早启动会让验证集的 workers 与训练数据加载争抢CPU
+            nonlocal val_batches
+            val_batches = utils.BackgroundLoader(val_loader)
+
+        train_loss_G = train(train_loader, model, tail_hook=start_val_prefetch if do_val else None,
+                             tail_steps=config.get('val_prefetch_steps', 8))
         lr_scheduler.step()
 
         log_info = ['epoch {}/{}'.format(epoch, epoch_max)]
@@ -166,10 +308,11 @@ def main(config_, save_path):
         log_info.append('train G: loss={:.4f}'.format(train_loss_G))
         writer.add_scalars('loss', {'train G': train_loss_G}, epoch)
 
-        save_model(config, model, save_path, 'last')
+        # 验证不改变参数，best 直接复用这份快照，避免再做一次完整的 D2H 拷贝
+        epoch_state = save_model(config, model, save_path, 'last', epoch, force=(epoch == epoch_max))
 
-        if (epoch_val is not None) and (epoch % epoch_val == 0):
-            result1, result2, result3, result4, metric1, metric2, metric3, metric4 = eval_psnr(val_loader, model,
+        if do_val:
+            result1, result2, result3, result4, metric1, metric2, metric3, metric4 = eval_psnr(val_batches, model,
                 eval_type=config.get('eval_type'))
 
             log_info.append('val: {}={:.4f}'.format(metric1, result1))
@@ -184,11 +327,11 @@ def main(config_, save_path):
             if config['eval_type'] != 'ber':
                 if result1 > max_val_v:
                     max_val_v = result1
-                    save_model(config, model, save_path, 'best')
+                    save_model(config, model, save_path, 'best', epoch, state=epoch_state)
             else:
                 if result3 < max_val_v:
                     max_val_v = result3
-                    save_model(config, model, save_path, 'best')
+                    save_model(config, model, save_path, 'best', epoch, state=epoch_state)
 
             t = timer.t()
             prog = (epoch - epoch_start + 1) / (epoch_max - epoch_start + 1)
@@ -199,6 +342,8 @@ def main(config_, save_path):
             log(', '.join(log_info))
             writer.flush()
 
+    wait_for_save()
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--config', default="configs/demo.yaml")
@@ -207,7 +352,7 @@ if __name__ == '__main__':
     args = parser.parse_args()
 
     with open(args.config, 'r') as f:
-        config = yaml.load(f, Loader=yaml.FullLoader)
+        config = yaml.load(f, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
         print('config loaded.')
 
     save_name = args.name
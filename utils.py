@@ -1,6 +1,9 @@
 import os
 import time
+import inspect
 import shutil
+import queue
+import threading
 
 import torch
 import numpy as np
@@ -34,6 +37,72 @@ class Timer():
         return time.time() - self.v
 
 
+class DataPrefetcher():
+    """ Copy the next batch to the GPU on a side stream while the current one is consumed.
+    """
+
+    def __init__(self, loader):
+        self.loader = iter(loader)
+        self.check_pinned = loader.pin_memory
+        self.stream = torch.cuda.Stream()
+        self.preload()
+
+    def preload(self):
+        try:
+            batch = next(self.loader)
+        except StopIteration:
+            self.next_batch = None
+            return
+        if self.check_pinned:
+            # Non-blocking copies silently become synchronous from pageable memory
+            assert all(v.is_pinned() for v in batch.values()), 'batch was not pinned by the DataLoader'
+            self.check_pinned = False
+        with torch.cuda.stream(self.stream):
+            self.next_batch = {k: v.cuda(non_blocking=True) for k, v in batch.items()}
+
+    def next(self):
+        torch.cuda.current_stream().wait_stream(self.stream)
+        batch = self.next_batch
+        if batch is not None:
+            for v in batch.values():
+                v.record_stream(torch.cuda.current_stream())
+        self.preload()
+        return batch
+
+
+class BackgroundLoader():
+    """ Iterate a DataLoader from a background thread, keeping up to max_prefetch batches ready.
+    """
+
+    def __init__(self, loader, max_prefetch=8):
+        self.loader = loader
+        self.pin_memory = loader.pin_memory
+        self.queue = queue.Queue(max_prefetch)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            for batch in self.loader:
+                self.queue.put(batch)
+        except Exception as e:
+            self.queue.put(e)
+        self.queue.put(None)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                break
+            if isinstance(batch, Exception):
+                raise batch
+            yield batch
+        self.thread.join()
+
+
 def time_text(t):
     if t >= 3600:
         return '{:.1f}h'.format(t / 3600)
@@ -93,7 +162,12 @@ def make_optimizer(param_list, optimizer_spec, load_sd=False):
         'adam': Adam,
         'adamw': AdamW
     }[optimizer_spec['name']]
-    optimizer = Optimizer(param_list, **optimizer_spec['args'])
+    optimizer_args = dict(optimizer_spec['args'])
+    # Use the single-kernel fused Adam/AdamW update when this torch build provides it
+    if Optimizer in (Adam, AdamW) and torch.cuda.is_available() \
+            and 'fused' in inspect.signature(Optimizer.__init__).parameters:
+        optimizer_args.setdefault('fused', True)
+    optimizer = Optimizer(param_list, **optimizer_args)
     if load_sd:
         optimizer.load_state_dict(optimizer_spec['sd'])
     return optimizer
@@ -119,113 +193,161 @@ def make_coord(shape, ranges=None, flatten=True):
 
 
 
-def calc_cod(y_pred, y_true):
-    batchsize = y_true.shape[0]
+class CODMetric():
+
+    def __init__(self):
+        self.metric_WFM = sod_metric.WeightedFmeasure()
+        self.metric_SM = sod_metric.Smeasure()
+        self.metric_EM = sod_metric.Emeasure()
+        self.metric_MAE = sod_metric.MAE()
+
+    def update(self, y_pred, y_true):
+        batchsize = y_true.shape[0]
+        with torch.no_grad():
+            assert y_pred.shape == y_true.shape
 
-    metric_FM = sod_metric.Fmeasure()
-    metric_WFM = sod_metric.WeightedFmeasure()
-    metric_SM = sod_metric.Smeasure()
-    metric_EM = sod_metric.Emeasure()
-    metric_MAE = sod_metric.MAE()
-    with torch.no_grad():
-        assert y_pred.shape == y_true.shape
+            for i in range(batchsize):
+                true, pred = \
+                    y_true[i, 0].cpu().data.numpy() * 255, y_pred[i, 0].cpu().data.numpy() * 255
 
-        for i in range(batchsize):
-            true, pred = \
-                y_true[i, 0].cpu().data.numpy() * 255, y_pred[i, 0].cpu().data.numpy() * 255
+                self.metric_WFM.step(pred=pred, gt=true)
+                self.metric_SM.step(pred=pred, gt=true)
+                self.metric_EM.step(pred=pred, gt=true)
+                self.metric_MAE.step(pred=pred, gt=true)
 
-            metric_FM.step(pred=pred, gt=true)
-            metric_WFM.step(pred=pred, gt=true)
-            metric_SM.step(pred=pred, gt=true)
-            metric_EM.step(pred=pred, gt=true)
-            metric_MAE.step(pred=pred, gt=true)
+    def compute(self):
+        wfm = self.metric_WFM.get_results()["wfm"]
+        sm = self.metric_SM.get_results()["sm"]
+        em = self.metric_EM.get_results()["em"]["curve"].mean()
+        mae = self.metric_MAE.get_results()["mae"]
 
-        fm = metric_FM.get_results()["fm"]
-        wfm = metric_WFM.get_results()["wfm"]
-        sm = metric_SM.get_results()["sm"]
-        em = metric_EM.get_results()["em"]["curve"].mean()
-        mae = metric_MAE.get_results()["mae"]
+        return sm, em, wfm, mae
 
-    return sm, em, wfm, mae
+
+def calc_cod(y_pred, y_true):
+    metric = CODMetric()
+    metric.update(y_pred, y_true)
+    return metric.compute()
 
 
 from sklearn.metrics import precision_recall_curve
 
 
-def calc_f1(y_pred,y_true):
-    batchsize = y_true.shape[0]
-    with torch.no_grad():
-        assert y_pred.shape == y_true.shape
-        f1, auc = 0, 0
-        y_true = y_true.cpu().numpy()
-        y_pred = y_pred.cpu().numpy()
-        for i in range(batchsize):
-            true = y_true[i].flatten()
-            true = true.astype(np.int)
-            pred = y_pred[i].flatten()
-
-            precision, recall, thresholds = precision_recall_curve(true, pred)
-
-            # auc
-            auc += roc_auc_score(true, pred)
-            # auc += roc_auc_score(np.array(true>0).astype(np.int), pred)
-            f1 += max([(2 * p * r) / (p + r+1e-10) for p, r in zip(precision, recall)])
-
-    return f1/batchsize, auc/batchsize, np.array(0), np.array(0)
+class F1Metric():
 
-def calc_fmeasure(y_pred,y_true):
-    batchsize = y_true.shape[0]
+    def __init__(self):
+        self.f1, self.auc, self.n = 0, 0, 0
 
-    mae, preds, gts = [], [], []
-    with torch.no_grad():
-        for i in range(batchsize):
-            gt_float, pred_float = \
-                y_true[i, 0].cpu().data.numpy(), y_pred[i, 0].cpu().data.numpy()
+    def update(self, y_pred, y_true):
+        batchsize = y_true.shape[0]
+        with torch.no_grad():
+            assert y_pred.shape == y_true.shape
+            y_true = y_true.cpu().numpy()
+            y_pred = y_pred.cpu().numpy()
+            for i in range(batchsize):
+                true = y_true[i].flatten()
+                true = true.astype(np.int)
+                pred = y_pred[i].flatten()
 
-            # # MAE
-            mae.append(np.sum(cv2.absdiff(gt_float.astype(float), pred_float.astype(float))) / (
-                        pred_float.shape[1] * pred_float.shape[0]))
-            # mae.append(np.mean(np.abs(pred_float - gt_float)))
-            #
-            pred = np.uint8(pred_float * 255)
-            gt = np.uint8(gt_float * 255)
+                precision, recall, thresholds = precision_recall_curve(true, pred)
 
-            pred_float_ = np.where(pred > min(1.5 * np.mean(pred), 255), np.ones_like(pred_float),
-                                   np.zeros_like(pred_float))
-            gt_float_ = np.where(gt > min(1.5 * np.mean(gt), 255), np.ones_like(pred_float),
-                                 np.zeros_like(pred_float))
+                # auc
+                self.auc += roc_auc_score(true, pred)
+                # auc += roc_auc_score(np.array(true>0).astype(np.int), pred)
+                self.f1 += max([(2 * p * r) / (p + r+1e-10) for p, r in zip(precision, recall)])
+        self.n += batchsize
 
-            preds.extend(pred_float_.ravel())
-            gts.extend(gt_float_.ravel())
+    def compute(self):
+        return self.f1 / self.n, self.auc / self.n, np.array(0), np.array(0)
 
-        RECALL = recall_score(gts, preds)
-        PERC = precision_score(gts, preds)
+
+def calc_f1(y_pred,y_true):
+    metric = F1Metric()
+    metric.update(y_pred, y_true)
+    return metric.compute()
+
+
+class FmeasureMetric():
+    """ Pixel-level precision/recall are kept as TP/FP/FN counts instead of per-pixel label lists.
+    """
+
+    def __init__(self):
+        self.mae = []
+        self.tp, self.fp, self.fn = 0, 0, 0
+
+    def update(self, y_pred, y_true):
+        batchsize = y_true.shape[0]
+        with torch.no_grad():
+            for i in range(batchsize):
+                gt_float, pred_float = \
+                    y_true[i, 0].cpu().data.numpy(), y_pred[i, 0].cpu().data.numpy()
+
+                # # MAE
+                self.mae.append(np.sum(cv2.absdiff(gt_float.astype(float), pred_float.astype(float))) / (
+                            pred_float.shape[1] * pred_float.shape[0]))
+                # mae.append(np.mean(np.abs(pred_float - gt_float)))
+                #
+                pred = np.uint8(pred_float * 255)
+                gt = np.uint8(gt_float * 255)
+
+                pred_bin = pred > min(1.5 * np.mean(pred), 255)
+                gt_bin = gt > min(1.5 * np.mean(gt), 255)
+
+                self.tp += np.logical_and(pred_bin, gt_bin).sum()
+                self.fp += np.logical_and(pred_bin, np.logical_not(gt_bin)).sum()
+                self.fn += np.logical_and(np.logical_not(pred_bin), gt_bin).sum()
+
+    def compute(self):
+        # Same zero-division behaviour as sklearn's recall_score/precision_score
+        RECALL = self.tp / (self.tp + self.fn) if self.tp + self.fn > 0 else 0.0
+        PERC = self.tp / (self.tp + self.fp) if self.tp + self.fp > 0 else 0.0
 
         fmeasure = (1 + 0.3) * PERC * RECALL / (0.3 * PERC + RECALL)
-        MAE = np.mean(mae)
+        MAE = np.mean(self.mae)
 
-    return fmeasure, MAE, np.array(0), np.array(0)
+        return fmeasure, MAE, np.array(0), np.array(0)
 
-from sklearn.metrics import roc_auc_score,recall_score,precision_score
+
+def calc_fmeasure(y_pred,y_true):
+    metric = FmeasureMetric()
+    metric.update(y_pred, y_true)
+    return metric.compute()
+
+from sklearn.metrics import roc_auc_score
 import cv2
+
+
+class BERMetric():
+
+    def __init__(self):
+        self.pos_err, self.neg_err, self.n = 0, 0, 0
+
+    def update(self, y_pred, y_true):
+        batchsize = y_true.shape[0]
+        y_pred, y_true = y_pred.permute(0, 2, 3, 1).squeeze(-1), y_true.permute(0, 2, 3, 1).squeeze(-1)
+        with torch.no_grad():
+            assert y_pred.shape == y_true.shape
+            y_true = y_true.cpu().numpy()
+            y_pred = y_pred.cpu().numpy()
+            for i in range(batchsize):
+                true = y_true[i].flatten()
+                pred = y_pred[i].flatten()
+
+                TP, TN, FP, FN, BER, ACC = get_binary_classification_metrics(pred * 255,
+                                                                             true * 255, 125)
+                self.pos_err += (1 - TP / (TP + FN)) * 100
+                self.neg_err += (1 - TN / (TN + FP)) * 100
+        self.n += batchsize
+
+    def compute(self):
+        return self.pos_err / self.n, self.neg_err / self.n, \
+            (self.pos_err + self.neg_err) / 2 / self.n, np.array(0)
+
+
 def calc_ber(y_pred, y_true):
-    batchsize = y_true.shape[0]
-    y_pred, y_true = y_pred.permute(0, 2, 3, 1).squeeze(-1), y_true.permute(0, 2, 3, 1).squeeze(-1)
-    with torch.no_grad():
-        assert y_pred.shape == y_true.shape
-        pos_err, neg_err, ber = 0, 0, 0
-        y_true = y_true.cpu().numpy()
-        y_pred = y_pred.cpu().numpy()
-        for i in range(batchsize):
-            true = y_true[i].flatten()
-            pred = y_pred[i].flatten()
-
-            TP, TN, FP, FN, BER, ACC = get_binary_classification_metrics(pred * 255,
-                                                                         true * 255, 125)
-            pos_err += (1 - TP / (TP + FN)) * 100
-            neg_err += (1 - TN / (TN + FP)) * 100
-
-    return pos_err / batchsize, neg_err / batchsize, (pos_err + neg_err) / 2 / batchsize, np.array(0)
+    metric = BERMetric()
+    metric.update(y_pred, y_true)
+    return metric.compute()
 
 def get_binary_classification_metrics(pred, gt, threshold=None):
     if threshold is not None: